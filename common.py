@@ -1,6 +1,18 @@
 import struct 
+import functools
 
 SEQ_NUM_SPACE = 1 << 16 
+SEQ_NUM_MASK = SEQ_NUM_SPACE - 1
+SEQ_NUM_HALF = SEQ_NUM_SPACE >> 1
+
+# precompiled segment header layouts. The header holds the sequence number,
+# a padding byte, the flags byte and the checksum
+_HEADER = struct.Struct('!HxBH')
+_HEADER_FIELDS = struct.Struct('!HBBH')
+_CHECKSUM = struct.Struct('>H')
+
+# length of a segment with no payload
+SEG_HEADER_SZ = _HEADER.size
 
 class InvalidSegmentError (Exception):
     pass
@@ -8,42 +20,85 @@ class InvalidSegmentError (Exception):
 class Segment:
     """
     Abstraction of a segment 
+
+    Flags are fixed once the segment is constructed. The encoding is cached,
+    so it must be invalidated if the sequence number or data are changed
     """
+    __slots__ = ('seq_num', 'ack', 'syn', 'fin', 'data', '_type', '_encoded')
+
     def __init__(self, seq_num=None, ack=None, syn=None, fin=None, data=None):
         self.seq_num = seq_num 
         self.ack = ack 
         self.syn = syn 
         self.fin = fin 
         self.data = data 
+        self._type = ('SYN' if syn else 'ACK' if ack else 'FIN' if fin 
+                      else 'DATA')
+        self._encoded = None
     
     def encode(self):
         """
-        Converts segment into a byte stream
+        Converts segment into a byte stream. The result is cached until 
+        invalidate is called
+        """
+        if self._encoded is None:
+            self._check_complete()
+            buf = bytearray(self.size())
+            self._pack_into(buf, 0)
+            self._encoded = bytes(buf)
+        return self._encoded
+
+    def invalidate(self):
+        """
+        Discards the cached encoding after the segment has been modified
+        """
+        self._encoded = None
+
+    def encode_into(self, buf, offset=0):
+        """
+        Encodes segment into a writable buffer, starting at offset. 
+        Returns the number of bytes written
         """
         self._check_complete()
+        if len(buf) - offset < self.size():
+            raise RuntimeError('buffer is too small for segment')
+        return self._pack_into(buf, offset)
 
-        packed_seg = self._pack_no_checksum() 
-        checksum = CRC16().encode(packed_seg)
-        return Segment._splice_checksum(packed_seg, struct.pack('>H', checksum))
+    def _pack_into(self, buf, offset):
+        """
+        Encodes a complete segment into buf at offset, which must have room
+        for it. Returns the number of bytes written
+        """
+        size = self.size()
+        flags = (self.ack<<2)|(self.syn<<1)|(self.fin)
+        if not self.data:
+            # control segments are a bare header
+            checksum = Segment._header_checksum(self.seq_num, flags)
+            _HEADER.pack_into(buf, offset, self.seq_num, flags, checksum)
+            return size
 
+        # pack with a 0 checksum, then checksum the packed bytes
+        end = offset + size
+        _HEADER.pack_into(buf, offset, self.seq_num, flags, 0)
+        buf[offset + _HEADER.size:end] = self.data
+        if offset == 0 and end == len(buf):
+            checksum = _CRC.encode(buf)
+        else:
+            checksum = _CRC.encode(buf[offset:end])
+        _CHECKSUM.pack_into(buf, offset + 4, checksum)
+        return size
 
-    def _pack_no_checksum(self):
+    def size(self):
         """
-        Encodes segment without adding checksum
+        Returns the encoded length of the segment in bytes
         """
-        return struct.pack('!HxBH', self.seq_num, (self.ack<<2)|(self.syn<<1)|(self.fin), 0) + self.data
+        return _HEADER.size + len(self.data)
     
     def type(self):
         """
         Returns string representation of segment type
         """
-        if self.syn:
-            return 'SYN'
-        if self.ack:
-            return 'ACK'
-        if self.fin:
-            return 'FIN'
-        return 'DATA'
+        return self._type
     
     def end_seq_num(self):
         """
@@ -55,14 +110,19 @@ class Segment:
         """
         Checks that segment fields are valid
         """
-        return (
-            self.seq_num != None and self.ack != None
-            and self.syn != None and self.fin != None
-            and self.data != None
-            and self.ack in (0, 1) and self.syn in (0, 1) and self.fin in (0, 1)
-            and self.ack + self.syn + self.fin <= 1
-            and 0 <= self.seq_num and self.seq_num < (1<<16)
-        )
+        ack, syn, fin = self.ack, self.syn, self.fin
+        try:
+            # flags must each be 0 or 1 with at most one set, and the 
+            # sequence number must fit in 16 bits
+            return (
+                ((ack | syn | fin) & ~1) == 0
+                and ack + syn + fin <= 1
+                and (self.seq_num & ~SEQ_NUM_MASK) == 0
+                and self.data is not None
+            )
+        except TypeError:
+            # a field is missing
+            return False
     
     def _check_complete(self):
         """
@@ -72,34 +132,59 @@ class Segment:
             raise InvalidSegmentError("Segment has missing or invalid fields")
     
     @staticmethod 
-    def decode(buffer : bytes): 
+    def decode(buffer : bytes, verify=True): 
         """
-        Parse a sequence of bytes into a segment. 
+        Parse a sequence of bytes (or any bytes-like object) into a segment. 
         Returns a tuple of the decoded segment and whether corruption was detected.
         
         Decoded segment is None if there is header corruption. If there is
-        payload corruption, the parsed segment is still returned.
+        payload corruption, the parsed segment is still returned. If verify
+        is False, the checksum is not checked, the corruption flag is None, 
+        and only the payload is copied out of the buffer
         """
 
-        if len(buffer) < 6:
+        if len(buffer) < _HEADER.size:
             raise InvalidSegmentError(f"Data is too short to be a segment")
         
-        data = buffer[6:]
-        seq_num, pad, flags, checksum = struct.unpack('!HBBH', buffer[:6])
-        checksum_valid = CRC16().verify(Segment._splice_checksum(buffer, b'\x00\x00'), checksum)
+        seq_num, pad, flags, checksum = _HEADER_FIELDS.unpack_from(buffer)
+        if not verify:
+            data = bytes(buffer[_HEADER.size:])
+            checksum_valid = None
+        else:
+            # take a copy if the buffer is a view into a reused receive 
+            # buffer. This also makes the checksum loop faster than 
+            # iterating a view
+            if type(buffer) is not bytes:
+                buffer = bytes(buffer)
 
-        # check for corrupted 0 bits
-        if (flags & 0xf8) or pad != 0:
-            return None, False
+            data = buffer[_HEADER.size:]
+            if data:
+                checksum_valid = _CRC.verify(buffer, checksum, skip_range=(4, 6))
+            else:
+                # a nonzero pad byte is rejected below, so it can be ignored
+                checksum_valid = checksum == Segment._header_checksum(seq_num, flags)
 
-        # check for invalid ack-syn-fin combination
-        ack, syn, fin = (flags>>2) & 1, (flags>>1) & 1, flags & 1 
-        if (ack + syn + fin > 1):
+        # check for corrupted 0 bits, and for an invalid ack-syn-fin 
+        # combination (clearing the lowest set flag must leave no flags set)
+        if pad or (flags & 0xf8) or (flags & (flags - 1)):
             return None, False
 
         # segment header is valid. Parse it
+        ack, syn, fin = (flags>>2) & 1, (flags>>1) & 1, flags & 1 
         return Segment(seq_num, ack, syn, fin, data), checksum_valid
     
+    @staticmethod
+    def _header_checksum(seq_num, flags):
+        """
+        Returns the checksum of a header with no payload and a 0 pad byte
+
+        The CRC is linear, so the checksum of the header is the sum of the
+        remainders of each of its nonzero bytes, looked up according to the
+        number of bytes that follow them
+        """
+        tables = _CRC.tables
+        return tables[5][seq_num >> 8] ^ tables[4][seq_num & 0xFF] ^ tables[2][flags]
+
     @staticmethod 
     def create(seq_num, type : str, data: bytes = b''):
         """
@@ -117,26 +202,18 @@ class Segment:
             raise RuntimeError('Unexpected type')
         
         return Segment(seq_num, *flags, data)
-    
-    @staticmethod
-    def _splice_checksum(buffer : bytes, checksum : bytes):
-        """
-        Splices checksum into an encoded segment buffer
-        """
-        assert len(checksum) == 2
-        return buffer[:4] + checksum + buffer[6:]
 
 
 def wrap_add(s, n):
     """
     Modulo add in sequence number space 
     """
-    return (s + n) % SEQ_NUM_SPACE
+    return (s + n) & SEQ_NUM_MASK
 def wrap_sub(s, n):
     """
     Modulo subtract in sequence number space 
     """
-    return (s - n + SEQ_NUM_SPACE) % SEQ_NUM_SPACE
+    return (s - n) & SEQ_NUM_MASK
 def wrap_cmp(s, n):
     """
     Modulo comparison in sequence number space 
@@ -145,20 +222,11 @@ def wrap_cmp(s, n):
     never occurs
     """
     
-    # handle wraparound
-    if abs(s - n) > SEQ_NUM_SPACE/2:
-        if s < n:
-            s += SEQ_NUM_SPACE
-        else:
-            n += SEQ_NUM_SPACE
-
-    # standard comparison
-    if s < n:
-        return -1
-    elif s == n:
+    # the wrapped difference is negative exactly when its top bit is set
+    diff = (s - n) & SEQ_NUM_MASK
+    if diff == 0:
         return 0
-    else:
-        return 1
+    return -1 if diff & SEQ_NUM_HALF else 1
     
 
 class CRC16:
@@ -166,56 +234,91 @@ class CRC16:
     Implements a 16-bit CRC check
     """
     def __init__(self, polynom = 0x16F63):
+        assert polynom.bit_length() == 17, f'polynomial must be of degree 16'
         self.polynom = polynom
+        self.tables = CRC16._make_tables(polynom)
 
-    def encode(self, data : bytes):
+    def encode(self, data : bytes, skip_range=None):
         """
         Returns integer representing CRC bits 
+
+        Bytes in the half-open range skip_range are treated as 0s
         """
-        return self._get_remainder(data, 0)
+        return self._get_remainder(data, 0, skip_range)
         
-    def verify(self, data, checksum):
+    def verify(self, data, checksum, skip_range=None):
         """
         Takes integer checksum and returns whether data matches it
+
+        Bytes in the half-open range skip_range are treated as 0s
         """
-        return self._get_remainder(data, checksum) == 0
+        return self._get_remainder(data, checksum, skip_range) == 0
     
-    def _get_remainder(self, data, initial_remainder):
+    def _get_remainder(self, data, initial_remainder, skip_range=None):
         if len(data) == 0:
             raise RuntimeError('cannot generate checksum for 0-length data')
         
-        datasz = len(data)
-        mdata = bytearray(data)
-        mdata += struct.pack('>H', initial_remainder)
-        
-        # perform polynomial division
-        byteptr = 0
-        bitshift = 0
-        while True:
-            # find next nonzero byte in data
-            while byteptr != datasz and mdata[byteptr] == 0:
-                byteptr += 1
-                bitshift = 0
-            if byteptr == datasz:
-                break
-            
-            # find next nonzero bit
-            while (mdata[byteptr] & (1<<(7-bitshift))) == 0:
-                bitshift += 1
-            assert bitshift < 8, f'error in bit shift'
-            
-            # perform a division
-            self.xor(mdata, byteptr, bitshift)
-        
-        # extract remainder and return
-        return struct.unpack('>H', mdata[-2:])[0]
-    
-    def xor(self, msg, byte, bitshift):
-        # format polynomial to be in the required bit position
-        polynom_bytes = struct.pack('>I', 
-                    self.polynom<<(32-self.polynom.bit_length())>>bitshift)[:3]
+        if skip_range is None:
+            crc = self._divide(0, data)
+        else:
+            # divide around the skipped bytes rather than building a copy
+            # of the data with them zeroed out
+            start, end = skip_range
+            crc = self._divide(0, data[:start])
+            crc = self._divide(crc, bytes(end - start))
+            crc = self._divide(crc, data[end:])
         
-        # perform xor
-        for i, j in zip(range(byte, byte + 3), range(0, 3)):
-            msg[i] ^= polynom_bytes[j]
-    
+        # the initial remainder sits in the 16-bit trailer, below the degree
+        # of the polynomial, so it is added to the remainder unchanged
+        return crc ^ initial_remainder
+
+    def _divide(self, crc, data):
+        """
+        Continues the polynomial division from remainder crc over data
+        """
+        t0, t1, t2, t3, t4, t5, t6, t7 = self.tables
+
+        # divide 8 bytes at a time. The remainder of each byte is looked up
+        # in the table for its distance from the end of the block, and the
+        # current crc is folded into the first two bytes
+        tail = len(data) % 8
+        if tail != len(data):
+            block = iter(data[:len(data) - tail])
+            for b0, b1, b2, b3, b4, b5, b6, b7 in zip(*(block,) * 8):
+                crc = (t7[(crc >> 8) ^ b0] ^ t6[(crc & 0xFF) ^ b1] 
+                       ^ t5[b2] ^ t4[b3] ^ t3[b4] ^ t2[b5] ^ t1[b6] ^ t0[b7])
+
+        # divide the remaining bytes one at a time. The crc never exceeds 
+        # 16 bits, so the table index is always below 256
+        for byte in data[len(data) - tail:]:
+            crc = ((crc & 0xFF) << 8) ^ t0[(crc >> 8) ^ byte]
+        return crc
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _make_tables(polynom):
+        """
+        Builds 8 tables, where table k holds the remainder of each possible 
+        byte followed by k bytes and a 16-bit trailer of 0s
+        """
+        low_bits = polynom & 0xFFFF
+        table = []
+        for byte in range(256):
+            remainder = byte << 8
+            for _ in range(8):
+                if remainder & 0x8000:
+                    remainder = ((remainder << 1) ^ low_bits) & 0xFFFF
+                else:
+                    remainder = (remainder << 1) & 0xFFFF
+            table.append(remainder)
+        tables = [tuple(table)]
+
+        # each further table is the previous one divided through a 0 byte
+        for _ in range(7):
+            tables.append(tuple(((rem & 0xFF) << 8) ^ tables[0][rem >> 8] 
+                                for rem in tables[-1]))
+        return tuple(tables)
+
+
+# shared instance used to checksum segments
+_CRC = CRC16()
@@ -4,8 +4,8 @@ import sys
 import _io 
 import time
 from common import * 
-import threading 
-from collections import deque 
+import selectors
+import os
 
 random.seed()
     
@@ -16,14 +16,6 @@ class Receiver:
             self.next_seqnum = 0
             self.dup_acks = 0
             self.state = 'closed' 
-            self.lock = threading.Lock()
-            self.unacked_queue = deque()    # invariant: all bytes [snd_base, next_seqnum) are in queue. invariant 2: all segments have nonzero length
-        
-        def acquire(self):
-            self.lock.acquire()
-
-        def release(self):
-            self.lock.release()
 
     class Stats:
         def __init__(self):
@@ -48,42 +40,69 @@ class Receiver:
         self.time_start = None
 
     def run(self):
-        def recv_loop():
-            while True:
-                self.recv() 
-        threading.Thread(target=recv_loop).start()
+        # serve the socket and stdin from this thread rather than a separate
+        # receive thread. stdin is read unbuffered so no typed lines are left
+        # waiting in a buffer that select cannot see
+        sel = selectors.DefaultSelector()
+        sel.register(self.sock, selectors.EVENT_READ)
+        pending = b''
+        try:
+            sel.register(sys.stdin, selectors.EVENT_READ)
+        except PermissionError:
+            # epoll refuses regular files and /dev/null. Reading them never
+            # blocks, so run all of their commands up front
+            for line in sys.stdin.buffer.read().split(b'\n'):
+                self._run_command(line)
 
         while True:
-            #res = input("Enter seq num to send, and optional type (default ack): ").split(' ')
-            res = input().split(' ')
-            
-            type = 'ack'
-            seq_num = int(res[0])
-            if len(res) == 2:
-                type = res[1]
+            for key, _ in sel.select():
+                if key.fileobj is self.sock:
+                    self.recv()
+                    continue
+
+                chunk = os.read(sys.stdin.fileno(), 4096)
+                if not chunk:
+                    # send an unterminated last command, then keep serving 
+                    # the socket so that replies are still received and logged
+                    self._run_command(pending)
+                    sel.unregister(sys.stdin)
+                    continue
+                *lines, pending = (pending + chunk).split(b'\n')
+
+                for line in lines:
+                    self._run_command(line)
+
+    def _run_command(self, line : bytes):
+        res = line.decode().split()
+        if not res:
+            return
+        
+        type = 'ack'
+        seq_num = int(res[0])
+        if len(res) == 2:
+            type = res[1]
 
-            self.send(Segment.create(seq_num, type))
+        self.send(Segment.create(seq_num, type))
 
     def send(self, segment : Segment):
         self._write_log('snd', 'ok', segment)
         self.sock.sendto(segment.encode(), self.dest_address)
 
     def recv(self):
-        """Guarantees that the received segment uncorrupted ack"""
-        while True:
-            data, address = self.sock.recvfrom(self.BUFSZ)
-            if address != self.dest_address:
-                print("WARNING: Received data from unexpected address")
-                continue 
-
-            seg, no_cor = Segment.decode(data)
-            if not no_cor:
-                if seg != None:
-                    self._write_log('rcv', 'cor', seg)
-                continue 
-
-            self._write_log('rcv', 'ok', seg)
-            return seg
+        """Receives one datagram. Returns None unless it is an uncorrupted segment"""
+        data, address = self.sock.recvfrom(self.BUFSZ)
+        if address != self.dest_address:
+            print("WARNING: Received data from unexpected address")
+            return None
+
+        seg, no_cor = Segment.decode(data)
+        if not no_cor:
+            if seg != None:
+                self._write_log('rcv', 'cor', seg)
+            return None
+
+        self._write_log('rcv', 'ok', seg)
+        return seg
 
     def _write_log(self, type, action, seg):
         if self.time_start == None:
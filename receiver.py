@@ -5,10 +5,11 @@ import _io
 import time
 from common import * 
 import threading 
-from collections import deque 
-from select import select
 
 random.seed()
+
+# print warnings about individual packets. Errors are always printed
+DEBUG = False
     
 class Receiver:
     """
@@ -18,29 +19,23 @@ class Receiver:
         """
         Class to hold receiver state 
         """
-        def __init__(self):
+        def __init__(self, max_win):
             # next expected byte
             self.rcv_base = 0          
 
-            # buffer to hold out of order segments.
-            # - Invariant: sequence numbers of packets in buffer always 
-            #   greater than self.rcv_base
-            self.buffer = deque() 
+            # buffer holding the receive window, and whether each of its 
+            # bytes has been received. 
+            # - Invariant: index 0 of both always corresponds to rcv_base, 
+            #   so present[0] is 0 while the receiver is waiting for data
+            self.ring = bytearray(max_win)
+            self.present = bytearray(max_win)
 
             self.state = 'closed' 
-            self.lock = threading.Lock()
-        
-        def acquire(self):
-            """
-            Locks the control block 
-            """
-            self.lock.acquire()
-
-        def release(self):
-            """
-            Releases the control block 
-            """
-            self.lock.release()
+
+            # set once the timed wait has expired, and set to restart it. 
+            # These are the only fields shared with the wait timer thread
+            self.closed_evt = threading.Event()
+            self.wait_reset_evt = threading.Event()
 
     class Stats:
         """
@@ -57,7 +52,7 @@ class Receiver:
             self.dup_acks = 0
             self._last_ack_num = None
             
-    def __init__(self, textf : _io.TextIOWrapper, 
+    def __init__(self, textf : _io.BufferedWriter, 
                  logf : _io.TextIOWrapper, max_win, sock : socket, dest_address):
         self.textf = textf
         self.logf = logf
@@ -72,8 +67,21 @@ class Receiver:
         # maximum message size
         self.BUFSZ = 2048 
 
+        # reusable buffer for incoming datagrams
+        self._rxbuf = bytearray(self.BUFSZ)
+        self._rxview = memoryview(self._rxbuf)
+
+        # runs of 0 and 1 bytes, sliced to refill and mark the window buffers
+        self._zeros = memoryview(bytes(max_win))
+        self._ones = memoryview(b'\x01' * max_win)
+
+        # last ACK sent, and a buffer holding its encoding, reused while 
+        # rcv_base is unchanged
+        self._ack_seg = None
+        self._ack_bytes = bytearray(SEG_HEADER_SZ)
+
         # statistics, timing and state control block
-        self.scb = Receiver.StateControlBlock()
+        self.scb = Receiver.StateControlBlock(max_win)
         self.stats = Receiver.Stats()
         self.time_start = None
 
@@ -89,7 +97,7 @@ class Receiver:
             seg = self.recv()
             if seg.type() == 'SYN':        
                 self.scb.rcv_base = wrap_add(seg.seq_num, 1)
-                self.send(Segment.create(self.scb.rcv_base, 'ack'))
+                self.send_ack(self.scb.rcv_base)
                 
                 # check if this is the first SYN we received
                 if self.scb.state != 'est':
@@ -104,12 +112,13 @@ class Receiver:
 
         # enter data receive loop until FIN
         while True:
-            if seg.type() == 'FIN':
+            seg_type = seg.type()
+            if seg_type == 'FIN':
                 break
-            elif seg.type() != 'DATA':
-                self.panic(f"was expecting data segments; received {seg.type()}")
+            elif seg_type != 'DATA':
+                self.panic(f"was expecting data segments; received {seg_type}")
             self.process_data_segment(seg)
-            self.send(Segment.create(self.scb.rcv_base, 'ack'))
+            self.send_ack(self.scb.rcv_base)
             seg = self.recv()
 
         assert seg.type() == 'FIN'
@@ -120,29 +129,27 @@ class Receiver:
 
         # register and acknowledge the FIN
         self.stats.original_segs += 1
-        self.send(Segment.create(wrap_add(seg.seq_num, 1), 'ack'))
+        self.send_ack(wrap_add(seg.seq_num, 1))
         
-        # initiate timed wait state
+        # initiate timed wait state. The whole transfer has been logged by 
+        # now, so flush the log while the receiver is idle
         self.scb.state = 'time_wait'
-        wait_timer = threading.Timer(2*self.MSL / 1000, self.close)
-        wait_timer.start()
-        
+        self.logf.flush()
+        threading.Thread(target=self._time_wait_timer, daemon=True).start()
 
-        self.scb.acquire()
-        while self.scb.state != 'closed':
-            self.scb.release()
+        # receive with a timeout, so that the main thread never gets stuck 
+        # in a recv syscall. The timeout only bounds how late we notice the
+        # close, which is tiny next to 2*MSL
+        self.sock.settimeout(0.05)
 
-            # we use nonblocking sockets, so that the main thread
-            # never gest stuck in a recv syscall
-            read, write, error = select([self.sock], [], [], 0.001)
-            if not read:
-                self.scb.acquire()
+        while not self.scb.closed_evt.is_set():
+            try:
+                nbytes, address = self.sock.recvfrom_into(self._rxbuf)
+            except timeout:
                 continue
 
-            data, address = self.sock.recvfrom(self.BUFSZ, SOCK_NONBLOCK)
-            seg = self._process_sock_output(data, address)
+            seg = self._process_sock_output(self._rxview[:nbytes], address)
             if not seg:
-                self.scb.acquire()
                 continue
 
             # check that this is the same FIN as the original and send ACK
@@ -150,28 +157,35 @@ class Receiver:
                 self.panic(f"expected a fin, received {seg.type()}")
             if seg.seq_num != self.scb.rcv_base:
                 self.panic("fin has incorrect sequence number")
-            self.send(Segment.create(wrap_add(seg.seq_num, 1), 'ack'))
+            self.send_ack(wrap_add(seg.seq_num, 1))
 
-            # restart timer. There is a possible race here but it is 
-            # extremely unlikely and has no ill effects
-            wait_timer.cancel()
-            wait_timer = threading.Timer(2*self.MSL / 1000, self.close)
-            wait_timer.start()
-
-            self.scb.acquire()
-        self.scb.release()
+            # restart timer
+            self.scb.wait_reset_evt.set()
+        self.sock.settimeout(None)
 
     def panic(self, message):
         """
         Print error and exit 
         """
         print(f"ERROR: {message}")
+        self.logf.flush()
         exit()
         
+    def _time_wait_timer(self):
+        """
+        Closes the receiver once 2*MSL passes without the timed wait being 
+        restarted. Runs in its own thread
+        """
+        while self.scb.wait_reset_evt.wait(2*self.MSL / 1000):
+            self.scb.wait_reset_evt.clear()
+        self.close()
+
     def close(self):
-        self.scb.acquire()
-        self.scb.state = 'closed'
-        self.scb.release()
+        """
+        Ends the timed wait. Called from the wait timer thread, so it only
+        sets the event that the main thread polls
+        """
+        self.scb.closed_evt.set()
         
     def process_data_segment(self, segment : Segment):
         """
@@ -181,99 +195,101 @@ class Receiver:
         assert segment.type() == 'DATA', \
             f'process_data_segment called with non-data segment'
         
-        if len(segment.data) == 0:
+        # bind attributes used more than once to locals
+        scb = self.scb
+        stats = self.stats
+        rcv_base = scb.rcv_base
+        data = segment.data
+        nbytes = len(data)
+
+        if nbytes == 0:
             # packet is nonsensical
-            print('WARNING: dropping 0-length data packet')
+            if DEBUG:
+                print('WARNING: dropping 0-length data packet')
             return
-        if wrap_cmp(segment.seq_num, self.scb.rcv_base) == -1:
+
+        # offset of the segment into the receive window. The sequence number 
+        # comparison is inlined here, as this runs for every data segment: 
+        # the segment starts before rcv_base when the top bit is set
+        offset = (segment.seq_num - rcv_base) & SEQ_NUM_MASK
+        if offset & SEQ_NUM_HALF:
             # packet has already been received
-            self.stats.dup_segs += 1
+            stats.dup_segs += 1
             return
-        if wrap_cmp(segment.end_seq_num(), 
-                wrap_add(self.scb.rcv_base, self.max_win)) == 1:
+        seg_end = offset + nbytes
+        if seg_end > self.max_win:
             # sender's receive window must be bigger than ours; drop packet
             return
 
-        if segment.seq_num == self.scb.rcv_base:
-            # in order packet has arrived
-
-            # log stats and add packet to buffer
-            self.stats.original_segs += 1
-            self.stats.original_bytes += len(segment.data)
-            self.scb.buffer.appendleft(segment)
-            
-            # pop in-order packets from buffer, updating rcv_base
-            while (
-                self.scb.buffer
-                and self.scb.buffer[0].seq_num == self.scb.rcv_base
-            ):
-                delivery = self.scb.buffer.popleft()
-                self.scb.rcv_base = delivery.end_seq_num()
-                self.deliver_segment(delivery)
+        # check which of the segment's bytes have already been received
+        present = scb.present
+        held = present.count(1, offset, seg_end)
+        if held == nbytes:
+            # this is a duplicate segment
+            stats.dup_segs += 1
+            return
+        if held != 0:
+            self.panic(f'invalid segment '
+                       f'[{segment.seq_num, segment.end_seq_num()})'
+                       f' overlaps buffered data. {self._describe_buffer()}')
+
+        # this is a new segment; copy it into the window
+        ring = scb.ring
+        ring[offset:seg_end] = data
+        present[offset:seg_end] = self._ones[:nbytes]
+        stats.original_segs += 1
+        stats.original_bytes += nbytes
+
+        if offset == 0:
+            # in order packet has arrived. Deliver the contiguous run of 
+            # received bytes at the start of the window, then slide the 
+            # window past it
+            run = present.find(0)
+            if run == -1:
+                run = len(present)
+            self.deliver_data(ring[:run])
             
-            # check invariant that buffer should have only out of order
-            # segments before our rcv_base
-            if (
-                self.scb.buffer 
-                and wrap_cmp(self.scb.rcv_base, self.scb.buffer[0].seq_num) == 1
-            ):
-                self.panic(f'invalid segment sizes in buffer. '
-                           f'rcv_base={self.scb.rcv_base}; {self._describe_buffer()}')
-        else:
-            insert_at_end = True
-            for i in range(0, len(self.scb.buffer)):
-                if self.scb.buffer[i].seq_num == segment.seq_num:
-                    # this is a duplicate segment
-
-                    # check segment is of same size as before
-                    if (self.scb.buffer[i].end_seq_num() != segment.end_seq_num()):
-                        self.panic(f'invalid duplicate segment '
-                                   f'[{segment.seq_num, segment.end_seq_num()}). '
-                                   f'{self._describe_buffer()}')
-
-                    self.stats.dup_segs += 1
-                    insert_at_end = False
-                    break  
-                elif wrap_cmp(self.scb.buffer[i].seq_num, segment.seq_num) == 1:
-                    # the start of the segment just received is below the 
-                    # start of the segment we are currently examining
-
-                    # check that segment does not overlap the one we are currently examining
-                    if (wrap_cmp(segment.end_seq_num(), self.scb.buffer[i].seq_num) == 1):
-                        self.panic(f'invalid segment '
-                                   f'[{segment.seq_num, segment.end_seq_num()})'
-                                   f' overlaps buffer segment. {self._describe_buffer()}')
-                    
-                    # this is a new segment; insert it into buffer
-                    self.scb.buffer.insert(i, segment)
-                    self.stats.original_segs += 1
-                    self.stats.original_bytes += len(segment.data)
-                    insert_at_end = False
-                    break
-
-            if insert_at_end:
-                self.stats.original_segs += 1
-                self.stats.original_bytes += len(segment.data)
-                self.scb.buffer.append(segment)
+            zeros = self._zeros[:run]
+            del ring[:run]
+            ring += zeros
+            del present[:run]
+            present += zeros
+            scb.rcv_base = (rcv_base + run) & SEQ_NUM_MASK
     
     def _describe_buffer(self):
         """
         Helper function for describing current buffer state
         """
         desc = 'Buffer: '
-        for seg in self.scb.buffer:
-            desc += f'[{seg.seq_num}, {seg.end_seq_num()}) '
+        present = self.scb.present
+        start = present.find(1)
+        while start != -1:
+            end = present.find(0, start)
+            if end == -1:
+                end = len(present)
+            desc += (f'[{wrap_add(self.scb.rcv_base, start)}, '
+                     f'{wrap_add(self.scb.rcv_base, end)}) ')
+            start = present.find(1, end)
         return desc 
     
-    def deliver_segment(self, segment):
+    def deliver_data(self, data):
         """
-        Writes segment to output file
+        Writes in order data to output file
         """
-        self.textf.write(segment.data.decode('utf-8'))
+        self.textf.write(data)
         
-    def send(self, segment : Segment):
+    def send_ack(self, seq_num):
         """
-        Sends a segment
+        Sends an ACK for seq_num
+        """
+        if self._ack_seg is None or self._ack_seg.seq_num != seq_num:
+            self._ack_seg = Segment.create(seq_num, 'ack')
+            self._ack_seg.encode_into(self._ack_bytes)
+        self.send(self._ack_seg, self._ack_bytes)
+
+    def send(self, segment : Segment, encoded : bytearray):
+        """
+        Sends a segment, given its encoding
         """
         
         # update stats
@@ -284,7 +300,7 @@ class Receiver:
 
         # send and log
         self._write_log('snd', 'ok', segment)
-        self.sock.sendto(segment.encode(), self.dest_address)
+        self.sock.sendto(encoded, self.dest_address)
 
     def recv(self):
         """
@@ -293,8 +309,8 @@ class Receiver:
         corrupted segments are discarded
         """
         while True:
-            data, address = self.sock.recvfrom(self.BUFSZ)
-            seg = self._process_sock_output(data, address)
+            nbytes, address = self.sock.recvfrom_into(self._rxbuf)
+            seg = self._process_sock_output(self._rxview[:nbytes], address)
             if seg:
                 return seg
     
@@ -303,7 +319,8 @@ class Receiver:
         Processes raw data received from a socket into a segment  
         """
         if address != self.dest_address:
-            print("WARNING: Received data from unexpected address")
+            if DEBUG:
+                print("WARNING: Received data from unexpected address")
             return None
 
         seg, no_cor = Segment.decode(data)
@@ -325,17 +342,17 @@ class Receiver:
         Helper function to write a log entry
         """
         
-        # get time elapsed since start
-        elapsed = 0.0
+        # get time elapsed since start, rounded to hundredths of a 
+        # millisecond. It is kept as an integer and printed as milliseconds
+        now = time.perf_counter_ns()
         if self.time_start == None:
-            self.time_start = time.perf_counter_ns()
-        else:
-            elapsed = (time.perf_counter_ns() - self.time_start) / 1e6
+            self.time_start = now
+        elapsed = (now - self.time_start + 5000) // 10000
         
-        log_str = f'{type}  {action:<3}  {elapsed:7.2f}  {seg.type():<4}  {seg.seq_num:5d}  {len(seg.data):4d}\n' 
+        # write to log
+        log_str = f'{type}  {action:<3}  {elapsed // 100:4d}.{elapsed % 100:02d}  {seg.type():<4}  {seg.seq_num:5d}  {len(seg.data):4d}\n' 
 
         self.logf.write(log_str)
-        self.logf.flush()
             
         
 
@@ -353,11 +370,15 @@ max_win = int(sys.argv[4])
 
 # socket creation
 rcv_sock = socket(AF_INET, SOCK_DGRAM)
+
+# a large receive buffer absorbs bursts of segments sent across the window
+# while the receiver is busy, rather than dropping them
+rcv_sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 4<<20)
 src_addr = ('127.0.0.1', receiver_port)
 dest_addr = ('127.0.0.1', sender_port)
 rcv_sock.bind(src_addr)
 
-with open('receiver_log.txt', 'wt') as logf, open(txt_file_to_receive, 'wt') as textf:
+with open('receiver_log.txt', 'wt', buffering=1<<16) as logf, open(txt_file_to_receive, 'wb', buffering=1<<20) as textf:
     # run receiver
     receiver = Receiver(textf, logf, max_win, rcv_sock, dest_addr)
     receiver.run()
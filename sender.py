@@ -4,11 +4,16 @@ import sys
 import _io 
 import time
 from common import * 
-import threading 
+import select
+import mmap
+import os
 from collections import deque 
 
 random.seed()
 
+# print warnings about individual packets
+DEBUG = False
+
 class PLCModule:
     """
     Performs packet loss and corruption
@@ -34,6 +39,12 @@ class PLCModule:
         self.rlp = rlp 
         self.fcp = fcp
         self.rcp = rcp 
+
+        # a Bernoulli RV for each probability, specialised when it is 0 or 1
+        self._drop_fwd = PLCModule._bernoulli(flp)
+        self._drop_rev = PLCModule._bernoulli(rlp)
+        self._cor_fwd = PLCModule._bernoulli(fcp)
+        self._cor_rev = PLCModule._bernoulli(rcp)
         
         # logging details and statistics
         self.time_start = None
@@ -43,108 +54,125 @@ class PLCModule:
         # constants
         self.HEADER_SZ = header_sz
         self.BUFSZ = 2048
-        
-        self.lock = threading.Lock()
+
+        # reusable buffer for incoming datagrams, and a poller to wait on 
+        # the socket with a timeout
+        self._rxbuf = bytearray(self.BUFSZ)
+        self._rxview = memoryview(self._rxbuf)
+        self._poller = select.poll()
+        self._poller.register(self.socket, select.POLLIN)
     
     def send(self, seg : Segment): 
         """
         Sends a segment. 
         """
 
-        self.lock.acquire()
-        
         # drop with flp probability
-        if self._flip(self.flp):
+        if self._drop_fwd():
             self._write_log('snd', 'drp', seg)
             self.stats.fwd_drp += 1
-            self.lock.release()
             return
 
         data = seg.encode()
 
         # corrupt with fcp probability
-        if self._flip(self.fcp):
+        if self._cor_fwd():
             self._write_log('snd', 'cor', seg)
             self.stats.fwd_cor += 1
             self.socket.sendto(self._corrupt(data), self.address)
         else:
             self._write_log('snd', 'ok', seg)
             self.socket.sendto(data, self.address)
-            
-        self.lock.release()
-
-    def recv(self):
-        data = None
-        while True:
-            data, incoming_address = self.socket.recvfrom(self.BUFSZ)
-            if incoming_address != self.address:
-                print(f"WARNING: Received data from unexpected address {incoming_address}")
-                continue
-            
-            # parse segment
-            seg, no_cor = Segment.decode(data)
-            assert no_cor, "checksum was corrupted by transfer through localhost" 
-
-            # drop with rlp probability
-            if self._flip(self.rlp):
-                if seg != None: 
-                    self._write_log('rcv', 'drp', seg)
-                self.stats.rev_drp += 1
-                continue
 
-            # corrupt with rcp probability
-            if self._flip(self.rcp):
-                self._write_log('rcv', 'cor', seg)
-                self.stats.rev_cor += 1
-
-                corrupted_data = self._corrupt(data)
-
-                # ensure corruption worked
-                if Segment.decode(corrupted_data)[1]:
-                    print("WARNING: corruption failed to alter checksum")
+    def recv(self, timeout=None):
+        """
+        Receives one datagram, waiting at most timeout seconds if given. 
+        Returns None if the wait timed out or the datagram was discarded
+        """
+        if timeout is not None and not self._poller.poll(timeout * 1000):
+            return None
 
-                return corrupted_data
-            else:
-                self._write_log('rcv', 'ok', seg)
-                return data
+        # receive into the reused buffer, then copy out only the bytes 
+        # received, since the datagram is returned to the caller
+        nbytes, incoming_address = self.socket.recvfrom_into(self._rxbuf)
+        if incoming_address != self.address:
+            if DEBUG:
+                print(f"WARNING: Received data from unexpected address {incoming_address}")
+            return None
+        
+        # drop with rlp probability. The log only needs the header, so the
+        # checksum of a dropped datagram is not verified and only its 
+        # payload (empty for an ACK) is copied out of the receive buffer
+        if self._drop_rev():
+            seg, _ = Segment.decode(self._rxview[:nbytes], verify=False)
+            if seg != None: 
+                self._write_log('rcv', 'drp', seg)
+            self.stats.rev_drp += 1
+            return None
+
+        # parse segment
+        data = bytes(self._rxview[:nbytes])
+        seg, no_cor = Segment.decode(data)
+        assert no_cor, "checksum was corrupted by transfer through localhost" 
+
+        # corrupt with rcp probability
+        if self._cor_rev():
+            self._write_log('rcv', 'cor', seg)
+            self.stats.rev_cor += 1
+
+            # a single bit error is always detected by the CRC, so the
+            # corrupted datagram is not decoded again to check
+            return self._corrupt(data)
+        else:
+            self._write_log('rcv', 'ok', seg)
+            return data
     
     def _write_log(self, type, action, seg):
         """
         Helper function to write to a log
         """
         
-        # measure time
-        elapsed = None
+        # get time elapsed since start, rounded to hundredths of a 
+        # millisecond. It is kept as an integer and printed as milliseconds
+        now = time.perf_counter_ns()
         if self.time_start == None:
-            self.time_start = time.perf_counter_ns()
-            elapsed = 0.0
-        else:
-            elapsed = (time.perf_counter_ns() - self.time_start) / 1e6
+            self.time_start = now
+        elapsed = (now - self.time_start + 5000) // 10000
         
         # write to log
-        log_str = f'{type}  {action:<3}  {elapsed:7.2f}  {seg.type():<4}  {seg.seq_num:5d}  {len(seg.data):4d}\n' 
+        log_str = f'{type}  {action:<3}  {elapsed // 100:4d}.{elapsed % 100:02d}  {seg.type():<4}  {seg.seq_num:5d}  {len(seg.data):4d}\n' 
         self.logf.write(log_str)
-        self.logf.flush()
         
     def _corrupt(self, data : bytes):
         """
-        Flips 1 bit in a byte sequence
+        Flips 1 bit in a byte sequence, returning a bytearray
         """
         assert len(data) > self.HEADER_SZ, f"Tried to corrupt header-only data"
         corruption_idx = random.randrange(self.HEADER_SZ, len(data))
-        corruption_bit = random.randrange(0, 8)
+        corruption_bit = random.getrandbits(3)
         
-        corrupted = data[:corruption_idx] \
-                    + bytes((data[corruption_idx] ^ (1 << (7-corruption_bit)),)) \
-                    + data[corruption_idx+1:]
+        # flip the bit in a single mutable copy of the data. The copy is 
+        # returned as is, since sendto and Segment.decode accept a bytearray
+        corrupted = bytearray(data)
+        corrupted[corruption_idx] ^= 1 << corruption_bit
 
         return corrupted
     
-    def _flip(self, probability):
+    @staticmethod
+    def _bernoulli(probability):
         """
-        Simulates a Bernoulli RV
+        Returns a function simulating a Bernoulli RV. It compares a random 
+        32-bit integer to a threshold, and draws nothing if the outcome is 
+        certain
         """
-        return random.random() < probability 
+        if probability <= 0:
+            return lambda: False
+        if probability >= 1:
+            return lambda: True
+        
+        threshold = int(probability * (1 << 32))
+        getrandbits = random.getrandbits
+        return lambda: getrandbits(32) < threshold
     
 class Sender:
     """
@@ -152,7 +180,8 @@ class Sender:
     """
     class StateControlBlock:
         """
-        Sender state control
+        Sender state control. Only the sender's thread uses it, so it is 
+        not locked
         """
         def __init__(self):
             # first unacked sequence number
@@ -170,13 +199,6 @@ class Sender:
             self.unacked_queue = deque()
 
             self.state = 'closed' 
-            self.lock = threading.Lock()
-        
-        def acquire(self):
-            self.lock.acquire()
-
-        def release(self):
-            self.lock.release()
             
     class Stats:
         """
@@ -191,21 +213,13 @@ class Sender:
             self.fast_retransmissions = 0
             self.dup_acks = 0
             self.cor_acks = 0
-            
-            # lock is only used for total_segs and total_bytes_sent, since
-            # only these are accessed from multiple threads
-            self.lock = threading.Lock()
-
-        def acquire(self):
-            self.lock.acquire()
-
-        def release(self):
-            self.lock.release()
 
-    def __init__(self, textf : _io.TextIOWrapper, 
+    def __init__(self, src : mmap.mmap, 
                  max_win, rto, plc : PLCModule):
-        # text file to read from
-        self.textf = textf
+        # contents of the file to send, and the offset of the first byte 
+        # not yet segmented
+        self.src = src
+        self.src_offset = 0
         self.plc = plc
 
         # transmission parameters
@@ -216,9 +230,11 @@ class Sender:
         self.scb = Sender.StateControlBlock()
         self.stats = Sender.Stats()
 
-        # retransmission variables
-        self.rttimer = None
-        self.rtlock = threading.Lock()
+        # retransmission timer. When the deadline (in perf_counter seconds) 
+        # passes, the callback is run with its arguments. The timer is 
+        # checked while waiting for acks, so it needs no thread of its own
+        self.rt_deadline = None
+        self.rt_callback = None
 
         # initial sequence number variables
         self.isn = random.randrange(0, SEQ_NUM_SPACE)
@@ -230,40 +246,28 @@ class Sender:
         Main function to execute the sender 
         """
 
-        self.scb.acquire()
         self.scb.state = 'syn_sent'
-        self.scb.release()
         
         # initiate connection
         self.stop_wait_exchange(Segment.create(self.scb.snd_base, 'syn'))
 
-        self.scb.acquire()
         self.scb.state = 'est'
-        self.scb.release()
 
         # Note: we do not multithread sending and receiving acks. Rather,
         # we first send out our entire window, then listen for an ack.
         # There is little advantage to multithreading here since transmission
         # is blocked until the next ack is received and the window moves
-        self.scb.acquire()
         while self.scb.state != 'fin_wait':
             if self.scb.state == 'est':
-                self.scb.release()
                 self.transmit_window()
-            else:
-                self.scb.release()
 
             ack = self.recv()
             self.handle_ack(ack.seq_num)
-            self.scb.acquire()
-        self.scb.release()
 
         # finalise by exchanging fin segments
         self.stop_wait_exchange(Segment.create(self.scb.snd_base, 'fin'))
         
-        self.scb.acquire()
         self.scb.state = 'closed'
-        self.scb.release()
     
     
     def stop_wait_exchange(self, seg):
@@ -284,7 +288,6 @@ class Sender:
         self._stop_rttimer()
 
         # update the control block
-        self.scb.acquire()
         assert self.scb.snd_base == seg.seq_num, \
             f'scb.send_base and seqnum do not match in a stop-wait exchange'
         assert self.scb.next_seqnum == seg.seq_num, \
@@ -292,21 +295,21 @@ class Sender:
 
         self.scb.snd_base = wrap_add(self.scb.snd_base, 1)
         self.scb.next_seqnum = wrap_add(self.scb.next_seqnum, 1)
-        self.scb.release()
         
     def _stop_rttimer(self):
-        self.rtlock.acquire()
-        if self.rttimer != None:
-            self.rttimer.cancel()
-        self.rtlock.release()
+        self.rt_deadline = None
     
     def _set_stop_wait_rttimer(self, seg):
-        self.rtlock.acquire()
-        if self.rttimer != None:
-            self.rttimer.cancel()
-        self.rttimer = threading.Timer(self.rto / 1000, self.stop_wait_timeout, (seg,))
-        self.rttimer.start()
-        self.rtlock.release()
+        self.rt_deadline = time.perf_counter() + self.rto / 1000
+        self.rt_callback = (self.stop_wait_timeout, (seg,))
+
+    def _fire_rttimer(self):
+        """
+        Runs the retransmission timer's callback once its deadline passes
+        """
+        callback, args = self.rt_callback
+        self.rt_deadline = None
+        callback(*args)
 
     def stop_wait_timeout(self, seg):
         self.stats.timeouts += 1
@@ -317,102 +320,111 @@ class Sender:
         """
         Transmits all available window segments. 
         """
-        self.scb.acquire()
-        while wrap_cmp(self.scb.next_seqnum, 
-                       wrap_add(self.scb.snd_base, self.max_win)) == -1:
-            window_bytes_remaining = wrap_sub(
-                wrap_add(self.scb.snd_base, self.max_win), self.scb.next_seqnum)
-            nbytes = min(self.mss, window_bytes_remaining)
-
-            self.scb.release()
-            data = self.textf.read(nbytes)
-            self.scb.acquire()
+        scb = self.scb
+        queue = scb.unacked_queue
+        stats = self.stats
+        src = self.src
+        mss = self.mss
+
+        # the window only moves when an ack is handled on this thread, so its
+        # end is fixed for the loop. Sequence number comparisons are inlined:
+        # a < b when the top bit of (a - b) is set
+        win_end = (scb.snd_base + self.max_win) & SEQ_NUM_MASK
+        next_seqnum = scb.next_seqnum
+        while (next_seqnum - win_end) & SEQ_NUM_HALF:
+            window_bytes_remaining = (win_end - next_seqnum) & SEQ_NUM_MASK
+            nbytes = min(mss, window_bytes_remaining)
+            assert nbytes > 0, f'window has no room for a segment'
+
+            offset = self.src_offset
+            data = src[offset:offset + nbytes]
+            self.src_offset = offset + len(data)
 
             if len(data) == 0:
-                self.scb.state = 'closing'
+                scb.state = 'closing'
                 break
             else:
-                seg = Segment.create(self.scb.next_seqnum, 'data', data.encode())
-                self.scb.next_seqnum = wrap_add(self.scb.next_seqnum, len(data))
+                seg = Segment.create(next_seqnum, 'data', data)
+                next_seqnum = (next_seqnum + len(data)) & SEQ_NUM_MASK
+                scb.next_seqnum = next_seqnum
 
-                self.scb.unacked_queue.append(seg)
-                if len(self.scb.unacked_queue) == 1:
+                queue.append(seg)
+                if len(queue) == 1:
                     # If the queue was previously empty we need to start 
                     # the retransmission timer afresh
                     self._set_rttimer()
 
-                self.scb.release()
-                self.stats.original_segs_sent += 1
-                self.stats.original_bytes_sent += len(seg.data)
+                stats.original_segs_sent += 1
+                stats.original_bytes_sent += len(data)
                 self.send(seg)
-                self.scb.acquire()
-
-        self.scb.release()
 
     def handle_ack(self, ack_seq_num):
         """
         Logic for processing an incoming ack
         """
-        
-        self.scb.acquire()
 
-        # compare to current base
-        if wrap_cmp(ack_seq_num, self.scb.snd_base) == -1:
+        scb = self.scb
+        queue = scb.unacked_queue
+        snd_base = scb.snd_base
+        next_seqnum = scb.next_seqnum
+
+        # compare to current base. Sequence number comparisons are inlined: 
+        # a < b when the top bit of (a - b) is set, and a > b when 
+        # 0 < (a - b) & SEQ_NUM_MASK < SEQ_NUM_HALF
+        if (ack_seq_num - snd_base) & SEQ_NUM_HALF:
             # ack was below current window base. Should not occur
-            print("WARNING: ack below window base received")
-            self.scb.release()
+            if DEBUG:
+                print("WARNING: ack below window base received")
             return 
-        if wrap_cmp(ack_seq_num, self.scb.next_seqnum) == 1:
+        if 0 < (ack_seq_num - next_seqnum) & SEQ_NUM_MASK < SEQ_NUM_HALF:
             # ack is greater than any segment we've sent.
-            print("WARNING: ack above window base received")
-            self.scb.release()
+            if DEBUG:
+                print("WARNING: ack above window base received")
             return 
-        if ack_seq_num == self.scb.snd_base:
+        if ack_seq_num == snd_base:
             # duplicate ack received
             self.stats.dup_acks += 1
-            self.scb.dup_acks += 1
-            if self.scb.dup_acks == 3:
-                self.scb.release()
+            scb.dup_acks += 1
+            if scb.dup_acks == 3:
                 self.triple_dup_ack()
-            else:
-                self.scb.release()
             return 
         
-        # Check that self.scb.snd_base < ack_seq_num <= self.scb.next_seqnum
-        assert wrap_cmp(self.scb.snd_base, ack_seq_num) == -1 \
-               and wrap_cmp(ack_seq_num, self.scb.next_seqnum) <= 0, \
+        # Check that snd_base < ack_seq_num <= next_seqnum
+        assert wrap_cmp(snd_base, ack_seq_num) == -1 \
+               and wrap_cmp(ack_seq_num, next_seqnum) <= 0, \
                f'ack_seq_num invariants failed'
 
-        # this is a cumulative ack; pop any segments with endpoint before the ack
-        while (
-            self.scb.unacked_queue
-            and wrap_cmp(self.scb.unacked_queue[0].end_seq_num(), ack_seq_num) <= 0
-        ): 
-            self.scb.unacked_queue.popleft()
+        # this is a cumulative ack; pop any segments with endpoint before the ack.
+        # The endpoint is computed inline, as it stays correct after a trim
+        popleft = queue.popleft
+        while queue:
+            head = queue[0]
+            if 0 < (head.seq_num + len(head.data) - ack_seq_num) & SEQ_NUM_MASK < SEQ_NUM_HALF:
+                break
+            popleft()
 
-        self.scb.snd_base = ack_seq_num
-        self.scb.dup_acks = 0
+        scb.snd_base = ack_seq_num
+        scb.dup_acks = 0
 
-        if self.scb.snd_base == self.scb.next_seqnum:
-            assert not self.scb.unacked_queue, f'Queue invariants failed'
+        if ack_seq_num == next_seqnum:
+            assert not queue, f'Queue invariants failed'
             self._stop_rttimer()
-            if self.scb.state == 'closing':
+            if scb.state == 'closing':
                 # all data segments have been acked
-                self.scb.state = 'fin_wait'
+                scb.state = 'fin_wait'
         else:
-            assert self.scb.unacked_queue, f'Queue invariants failed'
-            seg : Segment = self.scb.unacked_queue[0]
+            assert queue, f'Queue invariants failed'
+            seg : Segment = queue[0]
             
             # trim current segment if ack does not fall neatly on a segment line. 
             # This should never be necessary in our protocol, but is added for generality
-            trim_len = wrap_sub(ack_seq_num, seg.seq_num)
+            trim_len = (ack_seq_num - seg.seq_num) & SEQ_NUM_MASK
             if trim_len != 0:
-                seg.data = seg.data[trim_len:]
+                seg.data = memoryview(seg.data)[trim_len:]
                 seg.seq_num = ack_seq_num
+                seg.invalidate()
 
             self._set_rttimer()
-            
-        self.scb.release()
 
     def triple_dup_ack(self):
         """
@@ -434,20 +446,15 @@ class Sender:
 
         Returns whether retransmission was successful 
         """
-        self.scb.acquire()
-
         # reset timer and dup ack count
         self._set_rttimer()
         self.scb.dup_acks = 0
 
-        # get the segment to retransmit. May be None (rarely) if ack arrives
-        # and clears queue just before the timer is called
+        # get the segment to retransmit. May be None if the queue is empty
         seg = None
         if self.scb.unacked_queue:
             seg = self.scb.unacked_queue[0]
 
-        self.scb.release()
-
         if seg:
             self.send(seg)
             return True 
@@ -456,23 +463,15 @@ class Sender:
 
         
     def _set_rttimer(self):
-        self.rtlock.acquire()
-        if self.rttimer != None:
-            self.rttimer.cancel()
-        self.rttimer = threading.Timer(self.rto / 1000, self.timeout)
-        self.rttimer.start()
-        self.rtlock.release()
+        self.rt_deadline = time.perf_counter() + self.rto / 1000
+        self.rt_callback = (self.timeout, ())
 
     def send(self, segment : Segment):
         """
         Sends a segment
         """
-        
-        # send may be called from a timer, so we need to take a lock
-        self.stats.acquire()
         self.stats.total_segs_sent += 1
         self.stats.total_bytes_sent += len(segment.data)
-        self.stats.release()
         plc.send(segment)
 
     def recv(self):
@@ -480,10 +479,21 @@ class Sender:
         Receives a segment.
 
         Guarantees that the received segment is uncorrupted and is an ack. If it
-        not an ack, an error is thrown 
+        not an ack, an error is thrown. The retransmission timer is run 
+        while waiting
         """
         while True:
-            data = plc.recv()
+            # wait no longer than the retransmission deadline
+            timeout = None
+            if self.rt_deadline is not None:
+                timeout = self.rt_deadline - time.perf_counter()
+                if timeout <= 0:
+                    self._fire_rttimer()
+                    continue
+
+            data = plc.recv(timeout)
+            if data is None:
+                continue
             
             # check for corruption
             seg, no_cor = Segment.decode(data)
@@ -521,12 +531,18 @@ src_addr = ('127.0.0.1', sender_port)
 dest_addr = ('127.0.0.1', receiver_port)
 sender_sock.bind(src_addr)
 
-with open('sender_log.txt', 'wt') as logf, open(txt_file_to_send, 'r') as textf:
+with open('sender_log.txt', 'wt', buffering=1<<16) as logf, open(txt_file_to_send, 'rb') as textf:
+    # map the file to send rather than reading and encoding it piece by 
+    # piece. An empty file cannot be mapped, but there is nothing to send
+    src = b''
+    if os.fstat(textf.fileno()).st_size > 0:
+        src = mmap.mmap(textf.fileno(), 0, access=mmap.ACCESS_READ)
+
     # init PLC module
     plc = PLCModule(sender_sock, dest_addr, flp, rlp, fcp, rcp, logf)
     
     # run sender
-    sender = Sender(textf, max_win, rto, plc)
+    sender = Sender(src, max_win, rto, plc)
     sender.run()
     
     # write to log